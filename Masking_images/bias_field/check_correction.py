@@ -11,7 +11,7 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 from exploratory_pipeline.exploratory_analysis.data_loader import load_nifti
-import numpy as np
+from exploratory_pipeline.exploratory_analysis.check import affines_close
 import SimpleITK as sitk
 
 
@@ -28,4 +28,4 @@ if __name__ == "__main__":
 
     # Load the corrected_i
     print("Affine similarity checks:")
-    print("T1 vs Corrected T1:", np.allclose(t1_affine, t1_corrected_affine, atol=1e-3))
\ No newline at end of file
+    print("T1 vs Corrected T1:", affines_close(t1_affine, t1_corrected_affine, atol=1e-3))
\ No newline at end of file
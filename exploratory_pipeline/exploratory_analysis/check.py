@@ -10,9 +10,46 @@ def check_voxel_sizes(headers):
     print(f"Voxel sizes: {voxel_sizes}")
     return voxel_sizes
 
+def affines_close(affine_a, affine_b, atol=1e-5):
+    # Max absolute difference; avoids np.allclose's broadcasting/rtol machinery for 4x4 matrices
+    return bool(np.max(np.abs(affine_a - affine_b)) <= atol)
+
+def intensity_stats(data, block_size=1 << 18):
+    # Min/max/mean/std in a single pass over memory: each cache-sized block is reduced while it is
+    # resident, and the block means/variances are merged with Chan et al.'s pairwise update.
+    flat = np.ravel(data, order="K")
+    mn, mx = np.inf, -np.inf
+    count, mean, m2 = 0, 0.0, 0.0
+    for start in range(0, flat.size, block_size):
+        block = flat[start:start + block_size]
+        # np.minimum/np.maximum propagate NaNs like np.min/np.max (the builtins would drop them)
+        mn = np.minimum(mn, block.min())
+        mx = np.maximum(mx, block.max())
+        block_mean = block.mean(dtype=np.float64)
+        centred = block - block_mean
+        block_m2 = float(np.dot(centred, centred))
+        total = count + block.size
+        delta = block_mean - mean
+        mean += delta * block.size / total
+        m2 += block_m2 + delta * delta * count * block.size / total
+        count = total
+    return mn, mx, mean, np.sqrt(m2 / count)
+
+def check_affines(affines, names, atol=1e-5):
+    # All pairwise comparisons as one vectorized reduction over the stacked (n, 4, 4) affines
+    stacked = np.stack(affines)
+    first, second = np.triu_indices(len(affines), k=1)
+    max_diffs = np.abs(stacked[first] - stacked[second]).max(axis=(-2, -1))
+    print("Affine similarity checks:")
+    for i, j, max_diff in zip(first, second, max_diffs):
+        print(f"{names[i]} vs {names[j]}: {max_diff <= atol}")
+    return max_diffs
+
 def check_intensity_stats(data, image_name):
+    mn, mx, mean, std = intensity_stats(data)
     print(f"\nIntensity statistics for {image_name}:")
-    print(f" - Min: {np.min(data)}")
-    print(f" - Max: {np.max(data)}")
-    print(f" - Mean: {np.mean(data)}")
-    print(f" - Std: {np.std(data)}")
\ No newline at end of file
+    print(f" - Min: {mn}")
+    print(f" - Max: {mx}")
+    print(f" - Mean: {mean}")
+    print(f" - Std: {std}")
+    return mn, mx, mean, std
\ No newline at end of file
@@ -1,8 +1,46 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
 import nibabel as nib
 
-def load_nifti(path):
+# mkstemp creates owner-only files; cached copies get the usual umask-based mode instead
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def decompress_nifti(path, cache_dir):
+    # One-time conversion of a .nii.gz into an uncompressed .nii in cache_dir, so later loads skip
+    # single-threaded gzip decoding (and can be memory-mapped). The copy takes the full uncompressed
+    # size on disk and is never removed.
+    if not path.endswith(".nii.gz"):
+        return path
+    # Prefix with a hash of the source path so same-named files from different folders don't collide
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    cached_path = os.path.join(cache_dir, f"{key}_{os.path.basename(path)[:-len('.gz')]}")
+    if os.path.isfile(cached_path) and os.path.getmtime(cached_path) >= os.path.getmtime(path):
+        return cached_path
+    os.makedirs(cache_dir, exist_ok=True)
+    # Unique temp name, so concurrent loads of the same file don't write into each other
+    fd, tmp_path = tempfile.mkstemp(suffix=".nii.tmp", dir=cache_dir)
+    try:
+        with gzip.open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=16 * 1024 * 1024)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, cached_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return cached_path
+
+def load_nifti(path, cache_dir=None, memmap=False):
+    # memmap=True returns the data in its on-disk dtype instead of a float64 copy; for uncompressed
+    # (or cached) files without intensity scaling it is a memory map, read from disk on demand.
+    if cache_dir is not None:
+        path = decompress_nifti(path, cache_dir)
     image = nib.load(path)
-    data = image.get_fdata()
+    data = np.asanyarray(image.dataobj) if memmap else image.get_fdata()
     affine = image.affine
     header = image.header
-    return data, affine, header
\ No newline at end of file
+    return data, affine, header
@@ -1,4 +1,5 @@
 import matplotlib.pyplot as plt
+import numpy as np
 
 def plot_slices(images, titles, slice_idx=None):
     if slice_idx is None:
@@ -13,9 +14,12 @@ def plot_slices(images, titles, slice_idx=None):
 
     plt.show()
 
-def plot_histograms(data, image_name, bins = 100):
+def plot_histograms(data, image_name, bins = 100, value_range=None):
+    # Bin once with numpy and draw the counts as a single artist instead of one bar patch per bin.
+    # Passing value_range (e.g. the min/max from check_intensity_stats) skips numpy's own min/max pass.
+    counts, edges = np.histogram(data.ravel(order="K"), bins=bins, range=value_range)
     plt.figure(figsize=(10, 5))
-    plt.hist(data.ravel(), bins=bins)
+    plt.stairs(counts, edges, fill=True)
     plt.title(f"Histogram of {image_name}")
     plt.xlabel("Intensity")
     plt.ylabel("Frequency")
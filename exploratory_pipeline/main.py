@@ -1,10 +1,9 @@
 from exploratory_analysis.data_loader import load_nifti
-from exploratory_analysis.check import check_shapes, check_voxel_sizes, check_intensity_stats
+from exploratory_analysis.check import check_shapes, check_voxel_sizes, check_intensity_stats, check_affines
 from exploratory_analysis.visualization import plot_slices, plot_histograms
-import numpy as np
 import os
 
-def main():
+def main(cache_dir=None):
 
     # Load images
 
@@ -14,10 +13,12 @@ def main():
         os.path.join(base_path_mods, "FLAIR_canonical.nii_toMag.nii.gz"),
         os.path.join(base_path_mods, "lesion_mask_canonical.nii_toMag.nii.gz")
     ]
+    # Pass e.g. cache_dir=os.path.join(base_path_mods, "nii_cache") to keep uncompressed copies
+    # (full size on disk, never cleaned up) so re-runs skip gunzipping and are memory-mapped
     #base_folder = "exploratory_pipeline/data/preprocessed"
-    T1_data, T1_affine, T1_header = load_nifti(image_list[0])
-    T2_data, T2_affine, T2_header = load_nifti(image_list[1])
-    mask_data, affine_mask, header_mask = load_nifti(image_list[2])
+    T1_data, T1_affine, T1_header = load_nifti(image_list[0], cache_dir, memmap=True)
+    T2_data, T2_affine, T2_header = load_nifti(image_list[1], cache_dir, memmap=True)
+    mask_data, affine_mask, header_mask = load_nifti(image_list[2], cache_dir, memmap=True)
     #T1_data, T1_affine, T1_header = load_nifti(base_folder + "/T1_canonical.nii_toMag.nii.gz")
     #GRE_data, GRE_affine, GRE_header = load_nifti(base_folder + "/mag0000_canonical.nii.gz")
     #QSM_data, QSM_affine, QSM_header = load_nifti(base_folder + "/QSM_canonical.nii.gz")
@@ -30,10 +31,7 @@ def main():
     check_shapes(T1_data, T2_data, mask_data)
     check_voxel_sizes([T1_header, T2_header, header_mask])
 
-    print("Affine similarity checks:")
-    print("T1 vs T2:", np.allclose(T1_affine, T2_affine, atol=1e-5))
-    print("T1 vs Mask:", np.allclose(T1_affine, affine_mask, atol=1e-5))
-    print("T2 vs Mask:", np.allclose(T2_affine, affine_mask, atol=1e-5))
+    check_affines([T1_affine, T2_affine, affine_mask], ["T1", "T2", "Mask"], atol=1e-5)
 
     print("Affine T1")
     print(T1_affine)
@@ -48,8 +46,8 @@ def main():
 
 
     # Check intensity stats
-    check_intensity_stats(T1_data, "T1")
-    check_intensity_stats(T2_data, "GRE")
+    T1_min, T1_max, _, _ = check_intensity_stats(T1_data, "T1")
+    T2_min, T2_max, _, _ = check_intensity_stats(T2_data, "GRE")
     
 
     # Visualize slices for quick anatomical check
@@ -60,8 +58,8 @@ def main():
     )
 
     # Plot intensity histograms
-    plot_histograms(T1_data, "T1 Image")
-    plot_histograms(T2_data, "T2_data")
+    plot_histograms(T1_data, "T1 Image", value_range=(T1_min, T1_max))
+    plot_histograms(T2_data, "T2_data", value_range=(T2_min, T2_max))
     plot_histograms(mask_data, "Mask")
 
 
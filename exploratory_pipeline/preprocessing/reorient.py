@@ -11,6 +11,7 @@ import os
 import nibabel as nib
 import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 def reorient_to_canonical(image_path, output_path=None):
     """
@@ -60,6 +61,7 @@ def reorient_to_canonical(image_path, output_path=None):
 def batch_reorient(image_paths, output_dir):
     """
     Batch reorient multiple images and save them into a specified output directory.
+    Images are independent, so each one is reoriented in its own worker process.
     
     Parameters:
         image_paths (list of str): List of file paths to the images.
@@ -71,13 +73,19 @@ def batch_reorient(image_paths, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    reoriented_paths = []
+    output_paths = []
     for img_path in image_paths:
         # Derive a new file name in the output directory.
         base = os.path.basename(img_path).replace(".nii.gz", "").replace(".nii", "")
-        output_path = os.path.join(output_dir, f"{base}_canonical.nii.gz")
-        reoriented_img_path = reorient_to_canonical(img_path, output_path)
-        reoriented_paths.append(reoriented_img_path)
+        output_paths.append(os.path.join(output_dir, f"{base}_canonical.nii.gz"))
+
+    if not image_paths:
+        return []
+
+    # The work per image is dominated by gzip decode/encode, so scale across processes.
+    max_workers = min(len(image_paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        reoriented_paths = list(executor.map(reorient_to_canonical, image_paths, output_paths))
     return reoriented_paths
 
 if __name__ == "__main__":
@@ -12,8 +12,12 @@ Purpose:
   5) Save the output in "registered/lesions_MSpace_Mask.nii.gz".
 
 How:
-  - We define a helper function "apply_transform_to_mask" that uses SimpleITK.
-  - We then walk through each patient and year folder to perform the transformation.
+  - We define helpers that use SimpleITK: "load_context" reads the magnitude image and transform once,
+    "make_resampler" configures a resampler from them, and "resample_mask" resamples a mask with it
+    ("apply_transform_to_mask" wraps all of them).
+  - We then walk through each patient and year folder to collect the transformations to run
+    (one task per (patient, year)), and resample them in parallel with a thread pool; each
+    patient's lesion labels are read once and shared by its year folders.
 
 Assumptions:
   - Each patient folder has subfolders named "20*" for the years, plus "RESULTS_xnatSpaceMS".
@@ -24,134 +28,376 @@ Assumptions:
 """
 
 import os
-import SimpleITK as sitk
+import itertools
+import logging
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from tqdm import tqdm
+
+# Let ITK use every core unless the caller configured it; must be set before SimpleITK is imported.
+# SimpleITK itself is imported lazily inside the functions that use it, so runs that find nothing
+# to do (or only import this module) don't pay for loading it.
+os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(os.cpu_count() or 1))
+
+logger = logging.getLogger(__name__)
+
+# Parallel gzip for writing the .nii.gz masks, if installed (falls back to SimpleITK's zlib writer)
+PIGZ = shutil.which("pigz")
+
+# mkstemp creates owner-only files; the final masks get the usual umask-based mode instead
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+@lru_cache(maxsize=128)
+def _read_transform_cached(transform_matrix, mtime):
+    """
+    Parse a transform file once per (path, mtime); a modified file gets a new cache entry.
+    Only helps repeated calls on the same file; callers must not modify the returned object.
+    """
+    import SimpleITK as sitk
+
+    return sitk.ReadTransform(transform_matrix)
 
-def apply_transform_to_mask(mask_path, magnitude_path, transform_matrix, out_mask=None):
+def load_context(magnitude_path, transform_matrix):
     """
-    Apply the T1->magnitude transformation to a mask using nearest-neighbor interpolation.
+    Read the reference (magnitude) geometry and the T1->magnitude transform once, so they can be
+    reused for every mask resampled into that space.
+
+    Only the image header is read: resampling needs the reference size/spacing/origin/direction,
+    not its intensities, so the returned fixed image is an empty uint8 image with that geometry.
 
     Parameters
     ----------
-    mask_path : str
-        Path to the mask image (e.g., the lesion labels).
     magnitude_path : str
         Path to the magnitude image (fixed/reference space).
     transform_matrix : str
         Path to the transformation matrix from the T1->magnitude registration.
+
+    Returns
+    -------
+    tuple
+        (fixed_image, transform); the transform is the caller's own copy and may be modified.
+    """
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(magnitude_path)
+    reader.ReadImageInformation()
+    fixed_image = sitk.Image(reader.GetSize(), sitk.sitkUInt8)
+    fixed_image.SetSpacing(reader.GetSpacing())
+    fixed_image.SetOrigin(reader.GetOrigin())
+    fixed_image.SetDirection(reader.GetDirection())
+    # Copy the cached transform so callers changing its parameters don't corrupt later lookups
+    transform = sitk.Transform(_read_transform_cached(transform_matrix, os.path.getmtime(transform_matrix))).Downcast()
+    return fixed_image, transform
+
+def make_resampler(fixed_image, transform, num_work_units=None):
+    """
+    Configure a nearest-neighbor resampler into the space of 'fixed_image' once; call
+    Execute(mask_image) on it for every mask that shares this reference space and transform.
+
+    By default the output volume is split into os.cpu_count() work units, which ITK resamples in
+    parallel on its global thread pool (ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS threads).
+
+    Parameters
+    ----------
+    fixed_image : sitk.Image
+        Reference image (magnitude space), e.g. from load_context(); only its geometry is used.
+    transform : sitk.Transform
+        T1->magnitude transform, e.g. from load_context().
+    num_work_units : int, optional
+        Number of work units to split the output into (default: os.cpu_count()). Use 1 when
+        several resamplers already run concurrently.
+
+    Returns
+    -------
+    sitk.ResampleImageFilter
+        Resampler producing uint8 masks on the 'fixed_image' grid.
+    """
+    import SimpleITK as sitk
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetReferenceImage(fixed_image)
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    resampler.SetDefaultPixelValue(0)
+    resampler.SetTransform(transform)
+    resampler.SetNumberOfWorkUnits(num_work_units or os.cpu_count() or 4)
+    resampler.SetOutputPixelType(sitk.sitkUInt8)
+    return resampler
+
+def _save_mask(resampled_mask, mask_path, out_mask, pigz_threads=None):
+    """
+    Write a resampled mask and log where it came from. 'pigz_threads' is the number of compressor
+    threads (default: all cores); parallel callers should split the cores between their workers.
+    """
+    import SimpleITK as sitk
+
+    if out_mask.endswith(".gz") and PIGZ is not None:
+        # SimpleITK's zlib writer is single-threaded: write the plain .nii (header unchanged) and
+        # let pigz compress it on several cores, into a temporary file swapped in once complete
+        out_dir = os.path.dirname(out_mask) or "."
+        fd, tmp_nii = tempfile.mkstemp(suffix=".nii", dir=out_dir)
+        os.close(fd)
+        fd, tmp_gz = tempfile.mkstemp(suffix=".nii.gz.tmp", dir=out_dir)
+        os.close(fd)
+        try:
+            sitk.WriteImage(resampled_mask, tmp_nii, useCompression=False)
+            with open(tmp_gz, "wb") as dst:
+                subprocess.run([PIGZ, "-6", "-p", str(pigz_threads or os.cpu_count() or 1), "-n", "-c", tmp_nii], stdout=dst, check=True)
+            os.chmod(tmp_gz, 0o666 & ~_UMASK)
+            os.replace(tmp_gz, out_mask)
+        finally:
+            os.remove(tmp_nii)
+            # Only left behind if pigz (or the write) failed before the swap
+            if os.path.exists(tmp_gz):
+                os.remove(tmp_gz)
+    else:
+        # Label masks compress very well, so ask for it explicitly
+        sitk.WriteImage(resampled_mask, out_mask, useCompression=True, compressionLevel=6)
+
+    logger.info("[Mask Resampling Complete]")
+    logger.info(f"  Mask:              {mask_path}")
+    logger.info(f"  => Resampled Mask: {out_mask}")
+
+    return out_mask
+
+def resample_mask(mask_path, fixed_image, transform, out_mask=None, mask_image=None):
+    """
+    Resample a mask into the space of 'fixed_image' using nearest-neighbor interpolation.
+
+    Parameters
+    ----------
+    mask_path : str
+        Path to the mask image (e.g., the lesion labels).
+    fixed_image : sitk.Image
+        Reference image (magnitude space), e.g. from load_context(); only its geometry is used.
+    transform : sitk.Transform
+        T1->magnitude transform, e.g. from load_context().
     out_mask : str, optional
         Output path for the resampled mask.
+    mask_image : sitk.Image, optional
+        Already loaded mask (uint8). If given, it is used instead of reading 'mask_path' again.
 
     Returns
     -------
     str
         Path to the resampled mask in the magnitude space.
     """
+    import SimpleITK as sitk
+
     if out_mask is None:
         base = os.path.splitext(mask_path)[0]
         out_mask = base + "_toMag.nii.gz"
 
-    # Read the fixed image (reference) and the mask image
-    fixed_image = sitk.ReadImage(magnitude_path, sitk.sitkFloat32)
-    mask_image = sitk.ReadImage(mask_path, sitk.sitkUInt8)
-
-    # Read the transformation
-    transform = sitk.ReadTransform(transform_matrix)
+    # Read the mask image
+    if mask_image is None:
+        mask_image = sitk.ReadImage(mask_path, sitk.sitkUInt8)
 
     # Resample the mask using nearest neighbor interpolation
-    resampler = sitk.ResampleImageFilter()
-    resampler.SetReferenceImage(fixed_image)
-    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-    resampler.SetDefaultPixelValue(0)
-    resampler.SetTransform(transform)
-    resampled_mask = resampler.Execute(mask_image)
+    resampled_mask = make_resampler(fixed_image, transform).Execute(mask_image)
 
-    # Save the resampled mask
-    sitk.WriteImage(resampled_mask, out_mask)
+    return _save_mask(resampled_mask, mask_path, out_mask)
 
-    print("\n[Mask Resampling Complete]")
-    print(f"  Fixed (Magnitude): {magnitude_path}")
-    print(f"  Mask:              {mask_path}")
-    print(f"  => Resampled Mask: {out_mask}")
+def apply_transform_to_mask(mask_path, magnitude_path, transform_matrix, out_mask=None, mask_image=None):
+    """
+    Apply the T1->magnitude transformation to a mask using nearest-neighbor interpolation.
+    Convenience wrapper around load_context() and resample_mask().
 
-    return out_mask
+    Parameters
+    ----------
+    mask_path : str
+        Path to the mask image (e.g., the lesion labels).
+    magnitude_path : str
+        Path to the magnitude image (fixed/reference space).
+    transform_matrix : str
+        Path to the transformation matrix from the T1->magnitude registration.
+    out_mask : str, optional
+        Output path for the resampled mask.
+    mask_image : sitk.Image, optional
+        Already loaded mask (uint8). If given, it is used instead of reading 'mask_path' again.
 
-def transform_lesion_labels_in_directory(root_dir):
+    Returns
+    -------
+    str
+        Path to the resampled mask in the magnitude space.
+    """
+    fixed_image, transform = load_context(magnitude_path, transform_matrix)
+    return resample_mask(mask_path, fixed_image, transform, out_mask, mask_image=mask_image)
+
+class _SharedMasks:
     """
-    Iterate over each patient in 'root_dir', find year folders starting with '20', locate the transform
-    file, and apply it to the lesion label file in 'RESULTS_xnatSpaceMS'.
+    Lesion label images shared by the worker threads: each file is read once, by the first task
+    that needs it, and dropped again after the last task using it has finished.
+    """
+
+    def __init__(self, tasks):
+        self._remaining = Counter(task[0] for task in tasks)
+        self._locks = {path: threading.Lock() for path in self._remaining}
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        import SimpleITK as sitk
+
+        with self._locks[path]:
+            if path not in self._images:
+                self._images[path] = sitk.ReadImage(path, sitk.sitkUInt8)
+            return self._images[path]
+
+    def release(self, path):
+        with self._lock:
+            self._remaining[path] -= 1
+            if self._remaining[path] == 0:
+                self._images.pop(path, None)
+
+def _resample_task(task, masks, pigz_threads):
+    """
+    Run one (lesion_label_file, magnitude_path, transform_matrix, out_mask_path) task in a worker
+    thread: SimpleITK releases the GIL while filters execute, and each resample is kept to a single
+    work unit (and the compression to 'pigz_threads') so the pool does not oversubscribe the cores.
+    """
+    lesion_label_file, magnitude_path, transform_matrix, out_mask_path = task
+    try:
+        fixed_image, transform = load_context(magnitude_path, transform_matrix)
+        resampler = make_resampler(fixed_image, transform, num_work_units=1)
+        mask_image = masks.acquire(lesion_label_file)
+        return _save_mask(resampler.Execute(mask_image), lesion_label_file, out_mask_path, pigz_threads)
+    finally:
+        masks.release(lesion_label_file)
+
+def collect_tasks(root_dir, force=False):
+    """
+    Scan each patient in 'root_dir', find year folders starting with '20', locate the transform file
+    and the lesion label file in 'RESULTS_xnatSpaceMS', and build the work manifest.
+
+    Patients are returned in random order so that long and short patients mix across workers,
+    while the year folders of one patient stay adjacent: its lesion labels are then only held in
+    memory while its own tasks are in flight.
 
     Parameters
     ----------
     root_dir : str
         Path to either the baseline or follow_up directory.
+    force : bool
+        If False (default), skip year folders whose output mask is newer than the lesion labels,
+        the magnitude image and the transform it was computed from.
+
+    Returns
+    -------
+    list of tuple
+        (lesion_label_file, magnitude_path, transform_matrix, out_mask_path) per year folder.
     """
+    tasks_per_patient = []
+
     # 1) Loop over patient folders
-    for patient_id in os.listdir(root_dir):
-        patient_path = os.path.join(root_dir, patient_id)
-        if not os.path.isdir(patient_path):
-            continue
+    patient_dirs = [patient for patient in Path(root_dir).iterdir() if patient.is_dir()]
+
+    for patient in patient_dirs:
+        patient_id = patient.name
 
-        print(f"\n=== Processing patient: {patient_id} in {root_dir} ===")
+        logger.info(f"=== Processing patient: {patient_id} in {root_dir} ===")
 
         # 2) Locate the RESULTS_xnatSpaceMS folder and find the lesion label file
-        results_folder = os.path.join(patient_path, "RESULTS_xnatSpaceMS")
-        if not os.path.isdir(results_folder):
-            print(f"  No RESULTS_xnatSpaceMS folder found for {patient_id}, skipping.")
+        results_folder = patient / "RESULTS_xnatSpaceMS"
+        if not results_folder.is_dir():
+            logger.info(f"  No RESULTS_xnatSpaceMS folder found for {patient_id}, skipping.")
             continue
 
-        # Attempt to find the lesion label file
-        lesion_label_file = None
-        for f in os.listdir(results_folder):
-            if "lesion_labels.nii.gz" in f:
-                lesion_label_file = os.path.join(results_folder, f)
-                break
-
+        # Attempt to find the lesion label file (stop scanning at the first match)
+        lesion_label_file = next(results_folder.glob("*lesion_labels.nii.gz"), None)
         if lesion_label_file is None:
-            print(f"  No lesion_labels.nii.gz found in {results_folder}, skipping.")
+            logger.info(f"  No lesion_labels.nii.gz found in {results_folder}, skipping.")
             continue
+        lesion_label_file = str(lesion_label_file)
 
         # 3) Loop over year folders that start with '20'
-        for folder_name in os.listdir(patient_path):
-            year_path = os.path.join(patient_path, folder_name)
-            if not os.path.isdir(year_path):
-                continue
-            if not folder_name.startswith("20"):
-                # Not a year folder
+        patient_tasks = []
+        for year_dir in sorted(patient.glob("20*")):
+            if not year_dir.is_dir():
                 continue
+            folder_name = year_dir.name
 
             # 4) Look for 'registered' folder
-            registered_folder = os.path.join(year_path, "registered")
+            registered_folder = str(year_dir / "registered")
             if not os.path.isdir(registered_folder):
-                print(f"  No 'registered' folder in {year_path}, skipping.")
+                logger.info(f"  No 'registered' folder in {year_dir}, skipping.")
                 continue
 
             # 5) Identify the transform matrix and magnitude image
             transform_matrix = os.path.join(registered_folder, "T1_corrected_canonical.nii_toMag_transform.tfm")
             if not os.path.isfile(transform_matrix):
-                print(f"  Transform matrix not found in {registered_folder}, skipping.")
+                logger.info(f"  Transform matrix not found in {registered_folder}, skipping.")
                 continue
 
             # We assume the magnitude image is "mag.nii.gz" in the same 'registered' folder
             magnitude_path = os.path.join(registered_folder, "mag_canonical.nii.gz")
             if not os.path.isfile(magnitude_path):
-                print(f"  Magnitude image not found in {registered_folder}, skipping.")
+                logger.info(f"  Magnitude image not found in {registered_folder}, skipping.")
                 continue
 
-            # 6) Apply transform to the lesion label file
+            # 6) Queue the transform of the lesion label file, unless the output is up to date
             out_mask_path = os.path.join(registered_folder, "lesions_MSpace_Mask.nii.gz")
-            print(f"  Applying transform for year folder: {folder_name}")
-            apply_transform_to_mask(
-                mask_path=lesion_label_file,
-                magnitude_path=magnitude_path,
-                transform_matrix=transform_matrix,
-                out_mask=out_mask_path
-            )
+            if not force and os.path.isfile(out_mask_path):
+                newest_input = max(os.path.getmtime(lesion_label_file),
+                                   os.path.getmtime(magnitude_path),
+                                   os.path.getmtime(transform_matrix))
+                if os.path.getmtime(out_mask_path) >= newest_input:
+                    logger.info(f"  Output already up to date for year folder: {folder_name}, skipping.")
+                    continue
+            logger.info(f"  Queuing transform for year folder: {folder_name}")
+            patient_tasks.append((lesion_label_file, magnitude_path, transform_matrix, out_mask_path))
+
+        if patient_tasks:
+            tasks_per_patient.append(patient_tasks)
+
+    random.shuffle(tasks_per_patient)
+    return [task for patient_tasks in tasks_per_patient for task in patient_tasks]
+
+def transform_lesion_labels_in_directory(root_dir, max_workers=None, force=False):
+    """
+    Apply the T1->magnitude transform of every year folder in 'root_dir' to the patient's lesion
+    label file (see collect_tasks()).
+
+    The (patient, year) tasks are independent, so they are dispatched to a thread pool. Threads
+    share the cached transforms and lesion labels and avoid pickling images between processes.
+
+    Parameters
+    ----------
+    root_dir : str
+        Path to either the baseline or follow_up directory.
+    max_workers : int, optional
+        Number of worker threads (default: min(8, os.cpu_count())).
+    force : bool
+        If False (default), skip year folders whose output mask is newer than the lesion labels,
+        the magnitude image and the transform it was computed from.
+    """
+    tasks = collect_tasks(root_dir, force=force)
+    if not tasks:
+        return
+
+    # Resample all queued masks in parallel
+    masks = _SharedMasks(tasks)
+    max_workers = max_workers or min(8, os.cpu_count() or 1)
+    # Split the cores between the workers' pigz processes
+    pigz_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_resample_task, tasks, itertools.repeat(masks), itertools.repeat(pigz_threads))
+        list(tqdm(results, total=len(tasks), desc=f"Resampling lesion labels in {os.path.basename(root_dir.rstrip(os.sep))}"))
 
 def main():
     """
     Main function to process both baseline and follow_up directories.
     Adjust baseline_dir and followup_dir to your actual paths.
     """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
     # Adjust to your actual paths
     base_dir = "/home/jbetancur/Desktop/codes/python_qsm/exploratory_pipeline/data_automatization/"
     
@@ -162,16 +408,16 @@ def main():
     #followup_dir_3dates_fixed = os.path.join(base_dir, "follow_up_3_folders_last_registration")
     
 
-    print(f"\n=== Processing baseline directory: {baseline_dir} ===")
+    logger.info(f"=== Processing baseline directory: {baseline_dir} ===")
     transform_lesion_labels_in_directory(baseline_dir)
 
-    print(f"\n=== Processing follow_up directory: {followup_dir} ===")
+    logger.info(f"=== Processing follow_up directory: {followup_dir} ===")
     transform_lesion_labels_in_directory(followup_dir)
 
-    #print(f"\n=== Processing follow_up directory: {followup_dir_3dates_fixed} ===")
+    #logger.info(f"=== Processing follow_up directory: {followup_dir_3dates_fixed} ===")
     #transform_lesion_labels_in_directory(followup_dir_3dates_fixed)
 
-    print("\nAll done.")
+    logger.info("All done.")
 
 if __name__ == "__main__":
     main()